@@ -5,6 +5,8 @@ import pickle
 import math
 import os
 
+import numpy as np
+
 from common.tokenization import (whitespace_tokenize, BertTokenizer, BasicTokenizer)
 
 
@@ -16,9 +18,9 @@ logger = logging.getLogger(__name__)
 VOCAB_NAME = 'vocab.txt'
 
 
-def load_squad_features(args, file, is_training):
+def get_cached_features_file(args, file):
     '''
-    Load SQuAD dataset from json file provided by 'file' parameter or just load from cache dir.
+    Get the path of the cached features of 'file', located in the cache dir if provided.
     '''
     if args.cache_dir is None:
         cached_features_file = file + '_{0}_{1}_{2}_{3}'.format(
@@ -28,6 +30,14 @@ def load_squad_features(args, file, is_training):
         cached_features_file = args.cache_dir.strip('/') + '/' + file.split('/')[-1] + '_{0}_{1}_{2}_{3}'.format(
             list(filter(None, args.bert_model.split('/'))).pop(), str(args.max_seq_length), str(args.doc_stride),
             str(args.max_query_length))
+    return cached_features_file
+
+
+def load_squad_features(args, file, is_training):
+    '''
+    Load SQuAD dataset from json file provided by 'file' parameter or just load from cache dir.
+    '''
+    cached_features_file = get_cached_features_file(args, file)
         
     vocab_file = os.path.join(os.path.abspath(args.bert_model), VOCAB_NAME)
     # tokenization
@@ -431,9 +441,19 @@ def get_answers(examples, features, results, args):
 
     if args.version_2_with_negative:
         null_vals = collections.defaultdict(lambda: (float("inf"),0,0))
-    for ex, feat, result in match_results(examples, features, results):
-        start_indices = _get_best_indices(result.start_logits, args.n_best_size)
-        end_indices = _get_best_indices(result.end_logits, args.n_best_size)
+    matched_results = list(match_results(examples, features, results))
+    # numpy logits get their n-best indices for all features at once
+    if matched_results and isinstance(matched_results[0][2].start_logits, np.ndarray):
+        all_start_indices = _get_best_indices_batch(
+            np.stack([result.start_logits for _, _, result in matched_results]), args.n_best_size).tolist()
+        all_end_indices = _get_best_indices_batch(
+            np.stack([result.end_logits for _, _, result in matched_results]), args.n_best_size).tolist()
+    else:
+        all_start_indices = [_get_best_indices(result.start_logits, args.n_best_size)
+                             for _, _, result in matched_results]
+        all_end_indices = [_get_best_indices(result.end_logits, args.n_best_size)
+                           for _, _, result in matched_results]
+    for (ex, feat, result), start_indices, end_indices in zip(matched_results, all_start_indices, all_end_indices):
         prelim_predictions = get_valid_prelim_predictions(start_indices, end_indices, feat, result, args)
         prelim_predictions = sorted(
                             prelim_predictions,
@@ -681,6 +701,12 @@ def _get_best_indices(logits, n_best_size):
     return best_indices
 
 
+def _get_best_indices_batch(logits, n_best_size):
+    """Get the n-best logits of every row from a 2D numpy array."""
+    # A stable sort picks the lowest index among ties, same as _get_best_indices
+    return np.argsort(-logits, axis=-1, kind='stable')[:, :n_best_size]
+
+
 def _compute_softmax(scores):
     """Compute softmax probability over raw logits."""
     if not scores:
@@ -0,0 +1,41 @@
+import torch
+
+
+class DataPrefetcher(object):
+    """
+    Wraps a DataLoader and copies the next batch to the device on a side stream,
+    so the host to device transfer overlaps with the computation of the current step.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.it = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            batch = next(self.it)
+        except StopIteration:
+            self.batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = tuple(t.to(self.device, non_blocking=True).long() for t in batch)
+
+    def __next__(self):
+        if self.batch is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.batch
+        # The tensors were allocated on the side stream but are consumed on the current one
+        for t in batch:
+            t.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
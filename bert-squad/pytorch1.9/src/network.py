@@ -90,20 +90,17 @@ def load_numpy_weights_in_bert(model, numpy_checkpoint_path):
         pointer.data = torch.from_numpy(array)
     return model
 
-def gelu(x):
-    return torch.nn.functional.gelu(x)
-
-def swish(x):
-    return x * torch.sigmoid(x)
-
 def layernorm(hidden_size):
     return nn.LayerNorm(hidden_size, eps=config['ln-epsilon'])
 
 def linear(in_chs, out_chs):
     return nn.Linear(in_chs, out_chs, bias=config['dense-use-bias'])
 
-#torch.nn.functional.gelu(x) # Breaks ONNX export
-ACT2FN = {"gelu": gelu, "tanh": torch.tanh,  "relu": torch.nn.functional.relu, "swish": swish}
+# Activations are modules so that the layers using them can be scripted by torch.jit
+ACT2FN = {"gelu": nn.GELU, "tanh": nn.Tanh,  "relu": nn.ReLU, "swish": nn.SiLU}
+
+# scaled_dot_product_attention (flash / memory efficient kernels) is only available from pytorch 2.0
+HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
 
 class LinearActivation(Module):
     r"""Fused Linear and activation Module.
@@ -116,7 +113,7 @@ class LinearActivation(Module):
         self.out_features = out_features
         self.bias = None
         assert act in ACT2FN, "Activation function is not found in activation dictionary."
-        self.act_fn = ACT2FN[act]
+        self.act_fn = ACT2FN[act]()
         self.weight = Parameter(torch.Tensor(out_features, in_features))
         if bias:
             self.bias = Parameter(torch.Tensor(out_features))
@@ -305,6 +302,9 @@ class BertSelfAttention(nn.Module):
         mixed_key_layer = self.key(hidden_states)
         mixed_value_layer = self.value(hidden_states)
 
+        if HAS_SDPA:
+            return self.fused_attention(mixed_query_layer, mixed_key_layer, mixed_value_layer, attention_mask)
+
         query_layer = self.transpose_for_scores(mixed_query_layer)
         key_layer = self.transpose_key_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
@@ -336,6 +336,31 @@ class BertSelfAttention(nn.Module):
 
         return context_layer
 
+    def fused_attention(self, mixed_query_layer, mixed_key_layer, mixed_value_layer, attention_mask):
+        # Fused attention without materializing the (bsz, heads, seq, seq) scores
+        seq_length = mixed_query_layer.size(0)
+        batch_size = mixed_query_layer.size(1)
+
+        # (seq, bsz, hidden) => (bsz, heads, seq, head_size)
+        query_layer = mixed_query_layer.view(seq_length, batch_size, self.num_attention_heads,
+                                             self.attention_head_size).permute(1, 2, 0, 3)
+        key_layer = mixed_key_layer.view(seq_length, batch_size, self.num_attention_heads,
+                                         self.attention_head_size).permute(1, 2, 0, 3)
+        value_layer = mixed_value_layer.view(seq_length, batch_size, self.num_attention_heads,
+                                             self.attention_head_size).permute(1, 2, 0, 3)
+
+        # The additive (bsz, 1, 1, seq) mask broadcasts over heads and query positions
+        context_layer = F.scaled_dot_product_attention(
+            query_layer, key_layer, value_layer,
+            attn_mask=attention_mask.to(query_layer.dtype),
+            dropout_p=self.dropout.p if self.training else 0.0,
+            is_causal=False)
+        # (bsz, heads, seq, head_size) => (seq, bsz, hidden)
+        context_layer = context_layer.permute(2, 0, 1, 3).contiguous()
+        context_layer = context_layer.view(seq_length, batch_size, self.all_head_size)
+
+        return context_layer
+
 
 class BertSelfOutput(nn.Module):
     def __init__(self, config):
@@ -394,7 +419,7 @@ class BertLayer(nn.Module):
         self.intermediate = BertIntermediate(config)
         self.output = BertOutput(config)
 
-    def forward(self, hidden_states, attention_mask):
+    def forward(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
         attention_output = self.attention(hidden_states, attention_mask)
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
@@ -3,21 +3,44 @@ import json
 import sys
 import time
 import argparse
+import contextlib
+import inspect
+import math
 import ctypes
 import subprocess
 
+import numpy as np
 import torch
-from torch.utils.data import (DataLoader, TensorDataset)
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import (DataLoader, TensorDataset, RandomSampler)
+from torch.utils.data.distributed import DistributedSampler
 from tqdm import *
 
 sys.path.append('..')
-from common.squad import (load_squad_features, RawResult, get_answers)
+from common.squad import (load_squad_features, get_cached_features_file, RawResult, get_answers)
 from src.config import config
 from src.network import BertForQuestionAnswering, BertConfig
 from src.lr_scheduler import LinearWarmUpScheduler
+from src.dataset import DataPrefetcher
 
 PROF_SAMPLES_PER_EPOCH = 3200
 
+# Narrow dtypes halve the host to device traffic, widened again on the device
+TRAIN_FIELDS = [('input_ids', np.int32), ('input_mask', np.int32), ('segment_ids', np.int32),
+                ('start_position', np.int16), ('end_position', np.int16)]
+
+def stack_attr(features, attr, dtype=np.int64):
+    '''
+    Stack the `attr` field of every feature into one tensor through a pre-allocated numpy array.
+    '''
+    first = getattr(features[0], attr)
+    shape = (len(features), len(first)) if isinstance(first, list) else (len(features),)
+    arr = np.empty(shape, dtype=dtype)
+    for i, f in enumerate(features):
+        arr[i] = getattr(f, attr)
+    return torch.from_numpy(arr)
+
 def parse_arg():
     parser = argparse.ArgumentParser()
     ## Required parameters
@@ -48,7 +71,8 @@ def parse_arg():
                         help="The maximum length of an answer that can be generated. This is needed because the start "
                              "and end predictions are not conditioned on one another.")
     parser.add_argument("--verbose_logging", action='store_true',
-                        help="If true, all of the warnings related to data processing will be printed. "
+                        help="If true, all of the warnings related to data processing and the statistics of "
+                             "the model parameters will be printed. "
                              "A number of warnings are expected for a normal SQuAD evaluation.")
     parser.add_argument("--do_lower_case",
                         action='store_true',
@@ -77,28 +101,62 @@ def parse_arg():
                         help="Whether to profile model.")
     parser.add_argument("--train-batch-size", default=None, type=int,
                         help="The batch size of training.")
+    parser.add_argument("--num-workers", default=None, type=int,
+                        help="The number of DataLoader workers per process. Defaults to min(4, cpu_count / gpus). "
+                             "Since the features are already tensors in memory, 0 is often the fastest choice.")
+    parser.add_argument("--gradient-accumulation-steps", default=1, type=int,
+                        help="Number of batches to accumulate before each optimizer update. "
+                             "The learning rate is scaled with the resulting global batch size.")
+    # autocast only accepts a dtype (needed for bf16) from pytorch 1.10
+    amp_choices = ['fp16']
+    if 'dtype' in inspect.signature(torch.cuda.amp.autocast.__init__).parameters:
+        amp_choices.append('bf16')
+    parser.add_argument("--amp", default=None, type=str, choices=amp_choices,
+                        help="Mixed precision type for training. Train in fp32 if not set. "
+                             "bf16 requires pytorch >= 1.10.")
     args = parser.parse_args()
     return args
 
 def main():
     
     args = parse_arg()
-    print("---------configurations--------------")
-    for k, v in vars(args).items():
-        print(k,':',v)
-    print("-------------------------------------")
+
+    # Distributed training is enabled when launched by torchrun
+    distributed = 'LOCAL_RANK' in os.environ
+    if distributed:
+        dist.init_process_group("nccl")
+        local_rank = int(os.environ["LOCAL_RANK"])
+        rank = dist.get_rank()
+    else:
+        local_rank, rank = 0, 0
+    is_main = rank == 0
+
+    if is_main:
+        print("---------configurations--------------")
+        for k, v in vars(args).items():
+            print(k,':',v)
+        print("-------------------------------------")
     if args.train_batch_size is not None:
         config['train-batch-size'] = args.train_batch_size
+    # More workers than needed contend for the CPU and slow down the training
+    if args.num_workers is None:
+        args.num_workers = min(4, os.cpu_count() // int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+    config['dataset-num-workers'] = args.num_workers
+    loader_kwargs = {'num_workers': args.num_workers, 'persistent_workers': args.num_workers > 0}
+    if args.num_workers > 0:
+        loader_kwargs['prefetch_factor'] = 4
 
     # make output dir if not exist
-    if not os.path.exists(args.output_dir):
-        os.makedirs(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
 
     _cuda_tools_ext = ctypes.CDLL("libnvToolsExt.so")
     torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     
     # device
-    device = torch.device("cuda", 0)
+    torch.cuda.set_device(local_rank)
+    device = torch.device("cuda", local_rank)
 
     # model
     if args.init_checkpoint:
@@ -110,40 +168,105 @@ def main():
         checkpoint = torch.load(args.init_checkpoint, map_location='cpu')
         checkpoint = checkpoint["model"] if "model" in checkpoint.keys() else checkpoint
         model.load_state_dict(checkpoint, strict=False)
-        print(f"Load model from checkpoint: {args.init_checkpoint}")
+        if is_main:
+            print(f"Load model from checkpoint: {args.init_checkpoint}")
     else:
         model = BertForQuestionAnswering.from_pretrained(args.bert_model)
-        print(f"Load model from pretrained: {args.bert_model}")
+        if is_main:
+            print(f"Load model from pretrained: {args.bert_model}")
     model = model.to(device)
-    for name, param in list(model.named_parameters()):
-        mean = param.mean()
-        var = param.var()
-        print(f"{name}: {mean:.6f}, {var:.6f}")
+    # Without torch.compile, script the encoder layers to remove the python dispatch overhead
+    # and let the JIT fuse the elementwise ops. The scripted layers share the parameters.
+    if not hasattr(torch, 'compile'):
+        try:
+            model.bert.encoder.layer = torch.nn.ModuleList(
+                [torch.jit.script(layer) for layer in model.bert.encoder.layer])
+        except Exception as e:
+            if is_main:
+                print(f"Failed to script the encoder layers, fall back to eager mode: {e}")
+    # Training goes through the DDP wrapper, evaluation runs the bare model on rank 0 only
+    train_model = model
+    if distributed:
+        # The pooler is never called in forward, DDP would wait for its gradients forever
+        model.bert.pooler.requires_grad_(False)
+        ddp_model = DDP(model, device_ids=[local_rank], gradient_as_bucket_view=True)
+        train_model = ddp_model
+    # torch.compile is only available from pytorch 2.0, fall back to eager mode otherwise.
+    # Evaluation keeps the eager model to avoid recompiling for the eval batch shapes.
+    if hasattr(torch, 'compile'):
+        try:
+            compiled_model = torch.compile(train_model, mode="max-autotune")
+            # Compilation is lazy, so run a warm up forward/backward for failures to show up here
+            dummy_ids = torch.zeros((config["train-batch-size"], args.max_seq_length), dtype=torch.long, device=device)
+            start_logits, end_logits = compiled_model(dummy_ids, dummy_ids, torch.ones_like(dummy_ids))
+            (start_logits.sum() + end_logits.sum()).backward()
+            train_model = compiled_model
+        except Exception as e:
+            if is_main:
+                print(f"Failed to compile the model, fall back to eager mode: {e}")
+        model.zero_grad(set_to_none=True)
+    if is_main and args.verbose_logging:
+        # Gather the statistics of all parameters with a single device to host copy
+        named_params = list(model.named_parameters())
+        stats = torch.stack([torch.stack([p.detach().float().mean(), p.detach().float().var()])
+                             for _, p in named_params]).cpu().tolist()
+        for (name, _), (mean, var) in zip(named_params, stats):
+            print(f"{name}: {mean:.6f}, {var:.6f}")
 
     # Train DataLoader
-    _, train_features = load_squad_features(args, config["train-file"], True)
-    all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-    all_start_positions = torch.tensor([f.start_position for f in train_features], dtype=torch.long)
-    all_end_positions = torch.tensor([f.end_position for f in train_features], dtype=torch.long)
-    train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                               all_start_positions, all_end_positions)
-    train_dataloader = DataLoader(train_data, batch_size=config["train-batch-size"], shuffle=True,
-                                  pin_memory=True, num_workers=config['dataset-num-workers'], persistent_workers=True)
+    # Rank 0 builds the feature caches first, the other ranks then read them
+    if distributed and not is_main:
+        dist.barrier()
+    # The stacked arrays are cached next to the features, which skips tokenization on later runs
+    cached_train_arrays = get_cached_features_file(args, config["train-file"]) + '.npz'
+    train_tensors = None
+    if not args.skip_cache and os.path.exists(cached_train_arrays):
+        try:
+            with np.load(cached_train_arrays) as arrays:
+                train_tensors = [torch.from_numpy(arrays[attr]) for attr, _ in TRAIN_FIELDS]
+            if is_main:
+                print(f"Loaded training arrays from cache: {cached_train_arrays}")
+        except Exception as e:
+            # A broken cache (e.g. truncated write) is rebuilt from the features
+            if is_main:
+                print(f"Failed to load training arrays from cache, rebuilding them: {e}")
+    if train_tensors is None:
+        _, train_features = load_squad_features(args, config["train-file"], True)
+        train_tensors = [stack_attr(train_features, attr, dtype) for attr, dtype in TRAIN_FIELDS]
+        if not args.skip_cache and is_main:
+            print(f"Cached training arrays file: {cached_train_arrays}")
+            # Written under a temporary name first, so readers never see a partial file
+            tmp_train_arrays = f"{cached_train_arrays}.{os.getpid()}.tmp"
+            with open(tmp_train_arrays, "wb") as writer:
+                np.savez(writer, **{attr: t.numpy() for (attr, _), t in zip(TRAIN_FIELDS, train_tensors)})
+            os.replace(tmp_train_arrays, cached_train_arrays)
+    if distributed and is_main:
+        dist.barrier()
+    # sometimes the start/end positions are outside our model inputs, clamp them once to the
+    # ignored index (the sequence length) so these terms are skipped by the loss
+    all_start_positions, all_end_positions = train_tensors[3:]
+    all_start_positions.clamp_(0, args.max_seq_length)
+    all_end_positions.clamp_(0, args.max_seq_length)
+    train_data = TensorDataset(*train_tensors)
+    train_sampler = DistributedSampler(train_data) if distributed else RandomSampler(train_data)
+    train_dataloader = DataLoader(train_data, batch_size=config["train-batch-size"], sampler=train_sampler,
+                                  pin_memory=True, **loader_kwargs)
     
-    step_size = int(len(train_features) / config["train-batch-size"])
-    num_train_optimization_steps = step_size * args.num_train_epochs
+    step_size = int(len(train_sampler) / config["train-batch-size"])
+    # The last window of an epoch is flushed even when it is shorter than the accumulation steps
+    num_batches = len(train_dataloader)
+    num_train_optimization_steps = math.ceil(num_batches / args.gradient_accumulation_steps) * args.num_train_epochs
     
-    # Eval DataLoader
-    eval_examples, eval_features = load_squad_features(args, config["predict-file"], False)
-    all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-    all_example_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
-    eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_example_index)
-    eval_dataloader = DataLoader(eval_data, batch_size=config["predict-batch-size"], shuffle=False,
-                                  pin_memory=True, num_workers=config['dataset-num-workers'], persistent_workers=True)
+    # Eval DataLoader, only rank 0 evaluates
+    if is_main:
+        eval_examples, eval_features = load_squad_features(args, config["predict-file"], False)
+        all_input_ids = stack_attr(eval_features, 'input_ids', np.int32)
+        all_input_mask = stack_attr(eval_features, 'input_mask', np.int32)
+        all_segment_ids = stack_attr(eval_features, 'segment_ids', np.int32)
+        all_example_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
+        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_example_index)
+        eval_dataloader = DataLoader(eval_data, batch_size=config["predict-batch-size"], shuffle=False,
+                                     pin_memory=True, **loader_kwargs)
 
     # Optimizer
     assert config['optimizer-type'] == 'AdamW'
@@ -158,54 +281,93 @@ def main():
         {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': config['weight-decay']},
         {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
     ]
-    lr = config['lr-base'] * config["train-batch-size"] / config['lr-batch-denom']
-    optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=lr, betas=(0.9, 0.999), eps=1e-6)
+    # Linear scaling by the global batch size, which grows with the number of ranks
+    # and the number of accumulated batches per update
+    world_size = dist.get_world_size() if distributed else 1
+    global_batch_size = config["train-batch-size"] * world_size * args.gradient_accumulation_steps
+    lr = config['lr-base'] * global_batch_size / config['lr-batch-denom']
+    # Prefer the single kernel (fused) or multi tensor (foreach) implementations over the per parameter loop
+    adamw_kwargs = {'lr': lr, 'betas': (0.9, 0.999), 'eps': 1e-6}
+    try:
+        optimizer = torch.optim.AdamW(optimizer_grouped_parameters, fused=True, **adamw_kwargs)
+    except TypeError:
+        try:
+            optimizer = torch.optim.AdamW(optimizer_grouped_parameters, foreach=True, **adamw_kwargs)
+        except TypeError:
+            # pytorch 1.9 only exposes the multi tensor implementation as a separate module
+            optimizer = torch.optim._multi_tensor.AdamW(optimizer_grouped_parameters, **adamw_kwargs)
 
     # LR Scheduler
     scheduler = LinearWarmUpScheduler(optimizer, warmup=config['lr-warmup-proportion'], total_steps=num_train_optimization_steps)
     
+    # Mixed precision, loss scaling is only needed for fp16
+    autocast_kwargs = {'enabled': args.amp is not None}
+    if args.amp == 'bf16':
+        autocast_kwargs['dtype'] = torch.bfloat16
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp == 'fp16')
+
+    # Loss, the logits have one entry per token so ignored_index is the sequence length
+    ignored_index = args.max_seq_length
+    loss_fct = torch.nn.CrossEntropyLoss(ignore_index=ignored_index, reduction='none')
+
     # Record the Total time for train
     total_train_time = 0
     for epoch in range(int(args.num_train_epochs)):
         # Log some infomations
-        print(f"--------Epoch: {epoch:03}, " +
-            f"lr: {optimizer.param_groups[0]['lr']:f}--------")
+        if is_main:
+            print(f"--------Epoch: {epoch:03}, " +
+                f"lr: {optimizer.param_groups[0]['lr']:f}--------")
+        if distributed:
+            train_sampler.set_epoch(epoch)
         
         model.train()
-        train_iter = tqdm(train_dataloader, desc="Iteration", disable=args.disable_progress_bar)
+        train_iter = tqdm(DataPrefetcher(train_dataloader, device), desc="Iteration",
+                          disable=args.disable_progress_bar or not is_main)
 
         # Training loop
         start_time = time.time()
+        # Accumulated on the device, only synchronized once at the end of the epoch
+        running_loss = torch.zeros((), device=device)
         _cuda_tools_ext.nvtxRangePushA(ctypes.c_char_p(f"epoch:{epoch}".encode('utf-8')))
         _cuda_tools_ext.nvtxRangePushA(ctypes.c_char_p(f"prepare data".encode('utf-8')))
         for num_steps, batch in enumerate(train_iter):
-            # Move to device
-            batch = tuple(t.to(device) for t in batch)
+            # Already moved to device by the prefetcher
             input_ids, input_mask, segment_ids, start_positions, end_positions = batch
-            # Compute prediction and loss
-            _cuda_tools_ext.nvtxRangePop()
-            _cuda_tools_ext.nvtxRangePushA(ctypes.c_char_p(f"forward".encode('utf-8')))
-            start_logits, end_logits = model(input_ids, segment_ids, input_mask)
-            # sometimes the start/end positions are outside our model inputs, we ignore these terms
-            ignored_index = start_logits.size(1)
-            start_positions.clamp_(0, ignored_index)
-            end_positions.clamp_(0, ignored_index)
-            loss_fct = torch.nn.CrossEntropyLoss(ignore_index=ignored_index)
-            start_loss = loss_fct(start_logits, start_positions)
-            end_loss = loss_fct(end_logits, end_positions)
-            loss = (start_loss + end_loss) / 2
-            # Backpropagation
-            _cuda_tools_ext.nvtxRangePop()
-            _cuda_tools_ext.nvtxRangePushA(ctypes.c_char_p(f"gradient clean".encode('utf-8')))
-            optimizer.zero_grad()
-            _cuda_tools_ext.nvtxRangePop()
-            _cuda_tools_ext.nvtxRangePushA(ctypes.c_char_p(f"backpropagation".encode('utf-8')))
-            loss.backward()
+            # Gradients are only all-reduced on the last micro step of an accumulation window.
+            # no_sync must also cover the forward, since DDP prepares the reduction there.
+            window_start = num_steps - num_steps % args.gradient_accumulation_steps
+            window_size = min(args.gradient_accumulation_steps, num_batches - window_start)
+            update_step = num_steps + 1 == window_start + window_size
+            sync_context = ddp_model.no_sync() if distributed and not update_step else contextlib.nullcontext()
+            with sync_context:
+                # Compute prediction and loss
+                _cuda_tools_ext.nvtxRangePop()
+                _cuda_tools_ext.nvtxRangePushA(ctypes.c_char_p(f"forward".encode('utf-8')))
+                with torch.cuda.amp.autocast(**autocast_kwargs):
+                    start_logits, end_logits = train_model(input_ids, segment_ids, input_mask)
+                    # Start and end losses share one softmax + NLL over the concatenated logits,
+                    # each half is then averaged over its own valid targets as (start + end) / 2
+                    positions = torch.cat([start_positions, end_positions], dim=0)
+                    losses = loss_fct(torch.cat([start_logits, end_logits], dim=0), positions).view(2, -1)
+                    num_valid = (positions != ignored_index).view(2, -1).sum(dim=1)
+                    loss = (losses.sum(dim=1) / num_valid).mean()
+                # Backpropagation
+                _cuda_tools_ext.nvtxRangePop()
+                _cuda_tools_ext.nvtxRangePushA(ctypes.c_char_p(f"gradient clean".encode('utf-8')))
+                if num_steps == window_start:
+                    optimizer.zero_grad(set_to_none=True)
+                _cuda_tools_ext.nvtxRangePop()
+                _cuda_tools_ext.nvtxRangePushA(ctypes.c_char_p(f"backpropagation".encode('utf-8')))
+                scaler.scale(loss / window_size).backward()
+            running_loss += loss.detach()
             # Update (TODO: gradient clipping max_grad_norm=1.0)
             _cuda_tools_ext.nvtxRangePop()
             _cuda_tools_ext.nvtxRangePushA(ctypes.c_char_p(f"gradient update".encode('utf-8')))
-            optimizer.step()
-            scheduler.step()
+            if update_step:
+                scaler.step(optimizer)
+                scaler.update()
+                # The schedule advances even when the scaler skips an fp16 step on overflow
+                scheduler.step()
             _cuda_tools_ext.nvtxRangePop()
             _cuda_tools_ext.nvtxRangePushA(ctypes.c_char_p(f"prepare data".encode('utf-8')))
             if args.is_prof:
@@ -214,32 +376,39 @@ def main():
                     break
 
         _cuda_tools_ext.nvtxRangePop()
-        final_loss = loss.item()
+        final_loss, mean_loss = torch.stack([loss.detach(), running_loss / (num_steps + 1)]).tolist()
         _cuda_tools_ext.nvtxRangePop()
         total_train_time += time.time() - start_time
-        print(f"Train: Loss(last step): {final_loss:>.4e}, " + 
-            f"Batch Time: {(time.time() - start_time) * 1e3 /step_size:>.2f}ms")
+        if is_main:
+            print(f"Train: Loss(last step): {final_loss:>.4e}, Loss(mean): {mean_loss:>.4e}, " + 
+                f"Batch Time: {(time.time() - start_time) * 1e3 /step_size:>.2f}ms")
 
-        if not args.is_prof:
+        if not args.is_prof and is_main:
             # Validation process
             model.eval()
-            all_results = []
+            all_start_logits, all_end_logits, all_example_indices = [], [], []
             eval_iter = tqdm(eval_dataloader, desc="Iteration", disable=args.disable_progress_bar)
             for batch in eval_iter:
-                # Move to device
-                batch = tuple(t.to(device) for t in batch)
-                input_ids, input_mask, segment_ids, example_indices = batch
+                # Move to device, the example indices stay on host
+                input_ids, input_mask, segment_ids = (t.to(device, non_blocking=True).long() for t in batch[:3])
+                example_indices = batch[3]
                 # Forward computing
                 with torch.no_grad():
                     batch_start_logits, batch_end_logits = model(input_ids, segment_ids, input_mask)
-                for i, example_index in enumerate(example_indices):
-                    start_logits = batch_start_logits[i].detach().cpu().tolist()
-                    end_logits = batch_end_logits[i].detach().cpu().tolist()
-                    eval_feature = eval_features[example_index.item()]
-                    unique_id = int(eval_feature.unique_id)
-                    all_results.append(RawResult(unique_id=unique_id,
-                                            start_logits=start_logits,
-                                            end_logits=end_logits))
+                # Keep one tensor per batch, the per feature results are built after the loop
+                all_start_logits.append(batch_start_logits.cpu())
+                all_end_logits.append(batch_end_logits.cpu())
+                all_example_indices.append(example_indices)
+
+            all_start_logits = torch.cat(all_start_logits).numpy()
+            all_end_logits = torch.cat(all_end_logits).numpy()
+            all_example_indices = torch.cat(all_example_indices).numpy()
+            all_results = []
+            for start_logits, end_logits, example_index in zip(all_start_logits, all_end_logits, all_example_indices):
+                unique_id = int(eval_features[example_index].unique_id)
+                all_results.append(RawResult(unique_id=unique_id,
+                                        start_logits=start_logits,
+                                        end_logits=end_logits))
             
             # Write results into output file
             answers, _ = get_answers(eval_examples, eval_features, all_results, args)
@@ -256,9 +425,16 @@ def main():
             exact_match = float(scores.split(":")[1].split(",")[0])
             f1 = float(scores.split(":")[2].split(",")[0])
             print(f"Test: exact_match: {exact_match}, F1: {f1}")
+        # The other ranks wait here for the evaluation of rank 0, which has to finish
+        # within the process group timeout (30 minutes by default)
+        if distributed and not args.is_prof:
+            dist.barrier()
         
     # Print the training time
-    print("Time used: %.2fs" % (total_train_time))
+    if is_main:
+        print("Time used: %.2fs" % (total_train_time))
+    if distributed:
+        dist.destroy_process_group()
 
 if __name__ == "__main__":
     main()
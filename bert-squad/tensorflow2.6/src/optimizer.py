@@ -23,15 +23,17 @@ class WarmUp(tf.keras.optimizers.schedules.LearningRateSchedule):
         with tf.name_scope(self.name or 'WarmUp') as name:
             # Implements polynomial warmup. i.e., if global_step < warmup_steps, the
             # learning rate will be `global_step/num_warmup_steps * init_lr`.
+            # Both schedules are computed and selected with tf.where instead of tf.cond,
+            # so the learning rate stays a branchless subgraph that XLA can fuse.
             global_step_float = tf.cast(step, tf.float32)
             warmup_steps_float = tf.cast(self.warmup_steps, tf.float32)
-            warmup_percent_done = global_step_float / warmup_steps_float
+            warmup_percent_done = tf.minimum(global_step_float / warmup_steps_float, 1.0)
             warmup_learning_rate = (
                 self.initial_learning_rate *
                 tf.math.pow(warmup_percent_done, self.power))
-            return tf.cond(global_step_float < warmup_steps_float,
-                            lambda: warmup_learning_rate,
-                            lambda: self.decay_schedule_fn(step),
+            return tf.where(global_step_float < warmup_steps_float,
+                            warmup_learning_rate,
+                            self.decay_schedule_fn(step),
                             name=name)
 
     def get_config(self):
@@ -97,8 +99,11 @@ class AdamWeightDecay(tf.keras.optimizers.Adam):
         super(AdamWeightDecay, self).__init__(learning_rate, beta_1, beta_2,
                                             epsilon, amsgrad, name, **kwargs)
         self.weight_decay_rate = weight_decay_rate
-        self._include_in_weight_decay = include_in_weight_decay
-        self._exclude_from_weight_decay = exclude_from_weight_decay
+        self._include_in_weight_decay = [re.compile(r) for r in (include_in_weight_decay or [])]
+        self._exclude_from_weight_decay = [re.compile(r) for r in (exclude_from_weight_decay or [])]
+        # The patterns are compiled once and the decision is cached per variable,
+        # so retracing train_step does not match the patterns again
+        self._use_weight_decay_cache = {}
 
     @classmethod
     def from_config(cls, config):
@@ -161,13 +166,19 @@ class AdamWeightDecay(tf.keras.optimizers.Adam):
         if self.weight_decay_rate == 0:
             return False
 
-        if self._include_in_weight_decay:
-            for r in self._include_in_weight_decay:
-                if re.search(r, param_name) is not None:
-                    return True
-
-        if self._exclude_from_weight_decay:
-            for r in self._exclude_from_weight_decay:
-                if re.search(r, param_name) is not None:
-                    return False
+        do_decay = self._use_weight_decay_cache.get(param_name)
+        if do_decay is None:
+            do_decay = self._match_weight_decay(param_name)
+            self._use_weight_decay_cache[param_name] = do_decay
+        return do_decay
+
+    def _match_weight_decay(self, param_name):
+        """Matches `param_name` against the include and exclude patterns."""
+        for r in self._include_in_weight_decay:
+            if r.search(param_name) is not None:
+                return True
+
+        for r in self._exclude_from_weight_decay:
+            if r.search(param_name) is not None:
+                return False
         return True
\ No newline at end of file